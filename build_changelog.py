@@ -37,17 +37,49 @@ import git
 
 import datetime
 
+import time
+
 import email.utils
 
 import argparse
 
+import subprocess
+
+import functools
+
+import itertools
+
+import concurrent.futures
+
 from collections import OrderedDict, namedtuple
 
 CURRENT_ROLLING_SUITE = "trixie"
 
 changelog_entry = namedtuple("ChangelogEntry", ["author", "mail", "contents", "date"])
 
-not_allowed_regex = re.compile("[^a-z0-9_]+")
+slug_allowed_characters = "abcdefghijklmnopqrstuvwxyz0123456789_"
+
+class SlugTable(dict):
+	"""
+	A `str.translate()` table that keeps the characters allowed
+	in a slug, and maps every other character to a dot.
+
+	ASCII characters are looked up directly, everything else
+	goes through `__missing__()`.
+	"""
+
+	def __missing__(self, codepoint):
+		return "."
+
+slug_table = SlugTable(
+	(codepoint, chr(codepoint) if chr(codepoint) in slug_allowed_characters else ".")
+	for codepoint in range(128)
+)
+
+tz_offset_regex = re.compile("([+\\-]?)(\\d{2})(\\d{2})")
+
+# offset -> datetime.timezone, see tzinfo_from_offset()
+_tzinfo_cache = {}
 
 def none_on_exception(func, *args, **kwargs):
 	"""
@@ -80,7 +112,13 @@ def slugify(string):
 	:param: string: the string to slugify
 	"""
 
-	return not_allowed_regex.sub(".", string.lower())
+	slug = string.lower().translate(slug_table)
+
+	# Every run of not allowed characters is replaced by a single dot
+	while ".." in slug:
+		slug = slug.replace("..", ".")
+
+	return slug
 
 def tzinfo_from_offset(offset):
 	"""
@@ -89,24 +127,49 @@ def tzinfo_from_offset(offset):
 
 	This based on an answer by 'Turtles Are Cute' on
 	stackoverflow: https://stackoverflow.com/a/37097784
+
+	Most commits share a handful of offsets, so the resulting
+	objects are cached.
 	"""
 
-	sign, hours, minutes = re.match('([+\\-]?)(\\d{2})(\\d{2})', str(offset)).groups()
-	sign = -1 if sign == '-' else 1
-	hours, minutes = int(hours), int(minutes)
+	if offset not in _tzinfo_cache:
+		sign, hours, minutes = tz_offset_regex.match(str(offset)).groups()
+		sign = -1 if sign == '-' else 1
+		hours, minutes = int(hours), int(minutes)
 
-	return datetime.timezone(sign * datetime.timedelta(hours=hours, minutes=minutes))
+		_tzinfo_cache[offset] = datetime.timezone(
+			sign * datetime.timedelta(hours=hours, minutes=minutes)
+		)
+
+	return _tzinfo_cache[offset]
 
-def multiple_replace(string, matches, replacement):
+@functools.lru_cache(maxsize=1024)
+def format_commit_date(timestamp, offset):
 	"""
-	Replacement every occourence of the supplied iterable `matches`
-	in `string` with replacement (another string).
+	Returns an RFC 2822 date, suitable for debian/changelog,
+	given a commit timestamp and its offset.
+
+	:param: timestamp: the commit timestamp, as an int
+	:param: offset: the commit timezone offset, as a string (e.g. "+0200")
 	"""
 
-	for match in matches:
-		string = string.replace(match, replacement)
+	return email.utils.format_datetime(
+		datetime.datetime.fromtimestamp(timestamp, tzinfo_from_offset(offset))
+	)
+
+def read_file(path):
+	"""
+	Returns the contents of the supplied file, or None if
+	it doesn't exist.
 
-	return string
+	:param: path: the path of the file to read
+	"""
+
+	try:
+		with open(path, "r") as f:
+			return f.read()
+	except FileNotFoundError:
+		return None
 
 class SlimPackage:
 
@@ -167,23 +230,101 @@ class SlimPackage:
 		self.rolling_release_replacement = rolling_release_replacement
 		self.comment = slugify(comment.replace(self.branch_prefix, ""))
 
-		self._name = None
-		self._is_native = None
-		self._version = None
-		self._release = None
+		self.debian_directory = os.path.join(self.git_repository.working_dir, "debian")
+
+		# Matches any of the tag prefixes at the start of a tag name
+		self.tag_prefix_regex = re.compile(
+			"^(?:%s)" % "|".join(re.escape(prefix) for prefix in self.tag_prefixes)
+		)
+
 
-		self.tags = {
-			tag.commit.hexsha : tag.name
-			for tag in self.git_repository.tags
-			if tag.name.startswith(self.tag_prefixes) or tag.name.startswith("upstream/")
+		# Read the debian/ files and list the tags concurrently, as every
+		# access might be slow on networked filesystems. The results are
+		# picked up by the properties below when they're first needed.
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+		self._tags_future = executor.submit(self.get_tags)
+		self._debian_files = {
+			path : executor.submit(read_file, os.path.join(self.debian_directory, path))
+			for path in ("droidian-version-hint", "control", "source/format", "changelog")
 		}
+		executor.shutdown(wait=False)
 
-		hint_file = os.path.join(self.git_repository.working_dir, "debian/droidian-version-hint")
-		if os.path.exists(hint_file):
-			with open(hint_file, "r") as f:
-				self.version_hint = f.read().strip() or None
-		else:
-			self.version_hint = None
+	def get_tags(self):
+		"""
+		Returns a dictionary mapping commit hashes to the name of their
+		tag, for every tag starting with tag_prefixes or upstream/.
+		"""
+
+		# Resolve every tag with a single for-each-ref call. Annotated tags
+		# are peeled to the commit they point to (*objectname), while
+		# lightweight tags already point to it (objectname).
+		tags = {}
+		for line in self.git_repository.git.for_each_ref(
+			"--format=%(*objectname) %(objectname) %(refname:strip=2)",
+			"refs/tags"
+		).splitlines():
+			peeled, hexsha, tag_name = line.split(" ", 2)
+			if tag_name.startswith(self.tag_prefixes) or tag_name.startswith("upstream/"):
+				tags[peeled or hexsha] = tag_name
+
+		return tags
+
+	@functools.cached_property
+	def tags(self):
+		"""
+		Returns the tags dictionary, see `get_tags()`.
+		"""
+
+		return self._tags_future.result()
+
+	@functools.cached_property
+	def release_tags(self):
+		"""
+		Returns a dictionary mapping commit hashes to every tag with
+		our prefix, already stripped (i.e. "release/version").
+		These define the changelog blocks.
+		"""
+
+		return {
+			hexsha : self.strip_tag_prefix(tag_name)
+			for hexsha, tag_name in self.tags.items()
+			if tag_name.startswith(self.tag_prefixes)
+		}
+
+	@property
+	def version_hint(self):
+		"""
+		Returns the version hint from debian/droidian-version-hint,
+		or None.
+		"""
+
+		hint = self._debian_files["droidian-version-hint"].result()
+
+		return (hint.strip() or None) if hint is not None else None
+
+	def strip_tag_prefix(self, tag):
+		"""
+		Returns the supplied tag name without its prefix.
+
+		:param: tag: the tag name
+		"""
+
+		return self.tag_prefix_regex.sub("", tag, count=1)
+
+	def iter_tag_names(self):
+		"""
+		Yields the names of the tags found while walking the history
+		from commit_hash, nearest first.
+
+		The history is walked lazily, so callers that stop at the
+		first suitable tag don't traverse the whole history.
+		"""
+
+		tags = self.tags
+		for commit in self.git_repository.iter_commits(rev=self.commit_hash):
+			tag = tags.get(commit.hexsha)
+			if tag is not None:
+				yield tag
 
 	def get_version_from_non_native_tags(self):
 		"""
@@ -191,17 +332,11 @@ class SlimPackage:
 		at the nearest tags and taking in account eventual epochs.
 		"""
 
-		tags = [
-			self.tags[k.hexsha]
-			for k in self.git_repository.iter_commits(rev=self.commit_hash)
-			if k.hexsha in self.tags
-		] + [self.version_hint]
-
 		latest_upstream = None
-		for tag in tags:
+		for tag in itertools.chain(self.iter_tag_names(), [self.version_hint]):
 			if tag and tag.startswith(self.tag_prefixes):
 				# Explicit version, return
-				sanitized = multiple_replace(tag, self.tag_prefixes, "").split("/")[-1]
+				sanitized = self.strip_tag_prefix(tag).split("/")[-1]
 				if latest_upstream is None:
 					return sanitized
 				else:
@@ -233,62 +368,48 @@ class SlimPackage:
 		if nothing has been found.
 		"""
 
-		_changelog_path = os.path.join(self.git_repository.working_dir, "debian/changelog")
-		if os.path.exists(_changelog_path):
-			with open(_changelog_path, "r") as f:
-				try:
-					return f.readline().split(" ")[1][1:-1]
-				except:
-					pass
+		changelog = self._debian_files["changelog"].result()
+		if changelog is not None:
+			try:
+				return changelog.split("\n", 1)[0].split(" ")[1][1:-1]
+			except:
+				pass
 
 		return None
 
-	@property
+	@functools.cached_property
 	def name(self):
 		"""
 		Returns the source package name.
 		"""
 
-		if self._name is None:
-			# Retrieve the source package name from debian/control
-			_control_path = os.path.join(self.git_repository.working_dir, "debian/control")
-
-			if os.path.exists(_control_path):
-				with open(_control_path, "r") as f:
-					# Search for the source definition
-					for line in f:
-						if line.startswith("Source: "):
-							# Here we go!
-							self._name = line.strip().split(" ", 1)[-1]
-							break
+		# Retrieve the source package name from debian/control
+		control = self._debian_files["control"].result()
+		if control is None:
+			raise Exception("Unable to find debian/control")
 
-					if self._name is None:
-						raise Exception("Unable to determine the source package name!")
-			else:
-				raise Exception("Unable to find debian/control")
+		# Search for the source definition
+		for line in control.splitlines():
+			if line.startswith("Source: "):
+				# Here we go!
+				return line.strip().split(" ", 1)[-1]
 
-		return self._name
+		raise Exception("Unable to determine the source package name!")
 
-	@property
+	@functools.cached_property
 	def is_native(self):
 		"""
 		Returns True if the source package is native, False if not.
 		"""
 
-		if self._is_native is None:
-			# Check debian/source/format
-			_source_format_path = os.path.join(self.git_repository.working_dir, "debian/source/format")
-
-			if os.path.exists(_source_format_path):
-				with open(_source_format_path, "r") as f:
-					_format = f.read().strip()
-					self._is_native = not (_format == "3.0 (quilt)")
-			else:
-				raise Exception("Unable to find debian/source/format")
+		# Check debian/source/format
+		_format = self._debian_files["source/format"].result()
+		if _format is None:
+			raise Exception("Unable to find debian/source/format")
 
-		return self._is_native
+		return not (_format.strip() == "3.0 (quilt)")
 
-	@property
+	@functools.cached_property
 	def version(self):
 		"""
 		Returns the package version.
@@ -302,9 +423,11 @@ class SlimPackage:
 		Failing that, it defaults to "0.0.0".
 		"""
 
-		if self._version is not None:
-			# Return right now to avoid defining strategies again
-			return self._version
+		# The tags and the version hint are loaded in the background.
+		# Pick them up here, as the strategies below swallow any exception
+		# and a failure would otherwise silently change the version.
+		self.tags
+		self.version_hint
 
 		# There are a bunch of strategies to try to get an accurate version.
 		# These are tried top-bottom, and the first one to return a
@@ -312,7 +435,7 @@ class SlimPackage:
 		_starting_version_strategies = [
 			# If we have a tag (i.e. production builds), use directly that,
 			# as the version is specified there.
-			lambda: multiple_replace(self.tag, self.tag_prefixes, "").split("/")[-1] if self.tag is not None else None,
+			lambda: self.strip_tag_prefix(self.tag).split("/")[-1] if self.tag is not None else None,
 
 			# On non-native packages, search for the nearest tag between
 			# those starting with upstream/ and tag_prefixes (these are
@@ -327,7 +450,7 @@ class SlimPackage:
 
 			# Get the nearest tag starting with tag_prefixes using git describe
 			lambda: none_on_exception(
-				lambda x, y: multiple_replace(x.git.describe("--tags", "--always", "--abbrev=0", *["--match=%s*" % z for z in y]),y,"").split("/")[1],
+				lambda x, y: self.strip_tag_prefix(x.git.describe("--tags", "--always", "--abbrev=0", *["--match=%s*" % z for z in y])).split("/")[1],
 				self.git_repository,
 				self.tag_prefixes
 			),
@@ -361,173 +484,179 @@ class SlimPackage:
 			# really worry about that
 			version_template = "%s+git%s"
 
-		self._version = version_template % (
+		# The timestamp is in UTC, so that it doesn't depend on the
+		# timezone of the build machine
+		committed = time.gmtime(self.git_repository.commit(rev=self.commit_hash).committed_date)
+
+		version = version_template % (
 			starting_version,
 			".".join(
 				[
-					datetime.datetime.fromtimestamp(
-						self.git_repository.commit(rev=self.commit_hash).committed_date
-					).strftime("%Y%m%d%H%M%S"),
+					"%04d%02d%02d%02d%02d%02d" % committed[0:6],
 					self.commit_hash[0:7],
 					self.comment
 				]
 			)
 		)
 
-		if not self.is_native and not "-" in self._version:
+		if not self.is_native and not "-" in version:
 			# This could only happen when a version for a non-native package
 			# has been tagged without specifying the debian revision
 			raise Exception("Non native package but no debian revision specified while tagging!")
 
-		return self._version
+		return version
 
-	@property
+	@functools.cached_property
 	def release(self):
 		"""
 		Returns the target release.
 		"""
 
-		if not self._release and self.tag is not None:
-			self._release = multiple_replace(self.tag, self.tag_prefixes, "").split("/")[0]
-		elif not self._release and self.branch is not None:
-			self._release = self.branch.replace(self.branch_prefix, "").split("/")[0]
-		elif not self._release:
+		if self.tag is not None:
+			release = self.strip_tag_prefix(self.tag).split("/")[0]
+		elif self.branch is not None:
+			release = self.branch.replace(self.branch_prefix, "").split("/")[0]
+		else:
 			raise Exception("At least one between tag and branch must be specified")
 
 		if \
 			self.rolling_release is not None and \
 			self.rolling_release_replacement is not None and \
-			self._release == self.rolling_release:
-				self._release = self.rolling_release_replacement
+			release == self.rolling_release:
+				release = self.rolling_release_replacement
 
-		return self._release
+		return release
 
-	def iter_changelog(self):
+	def iter_commit_details(self, rev):
 		"""
-		Returns a formatted changelog
+		Yields a (hexsha, author name, author mail, commit date, message)
+		tuple for every commit reachable from `rev`, newest first.
+		The commit date is a (timestamp, offset) tuple, see
+		`format_commit_date()`.
+
+		The details are retrieved with a single `git log` call, so that
+		GitPython doesn't have to load and parse every commit object.
+
+		:param: rev: the commit to start from
 		"""
 
-		# Keep track of every tag with our prefix
-		tags = {
-			hexsha : multiple_replace(tag_name, self.tag_prefixes, "")
-			for hexsha, tag_name in self.tags.items()
-			if tag_name.startswith(self.tag_prefixes)
+		# Fields are NUL-separated, and so are commits thanks to -z.
+		# The message is the last field, as it can span multiple lines.
+		# Signature checks (log.showSignature) would be printed in front
+		# of the fields, so turn them off. git re-encodes commits that
+		# declare an encoding to UTF-8, but passes through those which
+		# don't: replace undecodable bytes, as GitPython does when
+		# parsing commit objects.
+		fields = self.git_repository.git.log(
+			"-z",
+			"--no-show-signature",
+			"--encoding=UTF-8",
+			"--date=raw",
+			"--format=%H%x00%an%x00%ae%x00%cd%x00%B",
+			rev,
+			stdout_as_string=False
+		).decode("utf-8", "replace").split("\x00")
+
+		for index in range(0, len(fields) - 1, 5):
+			hexsha, author, mail, date, message = fields[index:index+5]
+			timestamp, offset = date.split(" ")
+
+			yield (hexsha, author, mail, (int(timestamp), offset), message)
+
+	def format_changelog_entry(self, nearest_version, entry):
+		"""
+		Returns the debian/changelog block for the supplied entry.
+
+		:param: nearest_version: the "release/version" pair of the block
+		:param: entry: the `changelog_entry` to format
+		"""
+
+		release, version = nearest_version.split("/")
+
+		# Get number of authors
+		authors = len(entry.contents)
+
+		# Build the block contents in a single list, authors
+		# separated by an empty line
+		content = []
+		for author, messages in entry.contents.items():
+			if content:
+				content.append("\n")
+
+			if authors > 1:
+				content.append("  [ %s ]\n" % author)
+
+			content.extend(
+				"  * %s\n" % message
+				for message in reversed(messages)
+			)
+
+		return self.DEBIAN_CHANGELOG_TEMPLATE % {
+			"name" : self.name,
+			"version" : sanitize_tag_version(version),
+			"release" : release,
+			"content" : "".join(content).rstrip("\n"),
+			"author" : entry.author,
+			"mail" : entry.mail,
+			"date" : format_commit_date(*entry.date)
 		}
 
+	def iter_changelog(self):
+		"""
+		Returns a formatted changelog
+		"""
+
 		# Use the current release/version pair as the top version
 		nearest_version = "%s/%s" % (self.release, self.version)
 
-		entries = OrderedDict()
+		# Bind what's used in the loop below to locals, to avoid
+		# attribute lookups for every commit
+		commit_hash = self.commit_hash
+		release_tags = self.release_tags
+		format_changelog_entry = self.format_changelog_entry
+
+		# Every tagged commit marks the boundary of a changelog block.
+		# A tag on commit_hash itself doesn't start a new block.
+		boundary_hashes = frozenset(release_tags).difference((commit_hash,))
 
-		####
+		# Walk the history once, starting a new block at every tagged
+		# commit. The walk ends by itself at the root commit or, on
+		# shallow clones, at the shallow boundary: the last block is
+		# yielded once it's over.
 		entry = None
-		for commit in self.git_repository.iter_commits(rev=self.commit_hash):
+		for hexsha, author, mail, date, message in self.iter_commit_details(commit_hash):
 
-			# On shallow clones, the last commit actually has a parent,
-			# but we're unable to access it.
-			# Use this information to determine if we should stop
-			# here
-			if commit.parents:
-				try:
-					commit.parents[0].parents
-				except ValueError:
-					last_commit = True
-				else:
-					last_commit = False
-			else:
-				last_commit = True
-
-			if (commit.hexsha in tags and not commit.hexsha == self.commit_hash) \
-				or last_commit:
-
-				# new version, or root commit, should yield the previous
-				release, version = nearest_version.split("/")
-
-				# Store the commit if this is the last one
-				if last_commit:
-					if entry is None:
-						# This is an edge case, but I'm not a fan of
-						# repeating code - need to do something better here
-						entry = changelog_entry(
-							author=commit.author.name,
-							mail=commit.author.email,
-							date=email.utils.format_datetime(
-								git.objects.util.from_timestamp(
-									commit.committed_date,
-									commit.committer_tz_offset
-								)
-							),
-							contents=OrderedDict()
-						)
-
-					entry.contents.setdefault(
-						commit.author.name,
-						[]
-					).insert(
-						0,
-						commit.message.split("\n")[0] # Pick up only the first line
-					)
-
-				# Get number of authors
-				authors = len(entry.contents)
-
-				yield (
-					self.DEBIAN_CHANGELOG_TEMPLATE % {
-						"name" : self.name,
-						"version" : sanitize_tag_version(version),
-						"release" : release,
-						"content" : "\n\n".join(
-							[
-								("  [ %(author)s ]\n%(messages)s" if authors > 1 else "%(messages)s") % {
-									"author" : author,
-									"messages" : "\n".join(
-										[
-											"  * %s" % message
-											for message in messages
-										]
-									)
-								}
-								for author, messages in entry.contents.items()
-							]
-						),
-						"author" : entry.author,
-						"mail" : entry.mail,
-						"date" : entry.date
-					}
-				)
+			if hexsha in boundary_hashes:
+				# New version, yield the previous one
+				yield format_changelog_entry(nearest_version, entry)
 
-				# Reset entry
 				entry = None
+				nearest_version = release_tags[hexsha]
 
-				# If we should change version, do that
-				if not last_commit:
-					nearest_version = tags[commit.hexsha]
-				else:
-					break
-
-			# Create entry if we should
+			# Create entry if we should. The date is formatted only
+			# when the entry is yielded
 			if entry is None:
+				contents = OrderedDict()
 				entry = changelog_entry(
-					author=commit.author.name,
-					mail=commit.author.email,
-					date=email.utils.format_datetime(
-						git.objects.util.from_timestamp(
-							commit.committed_date,
-							commit.committer_tz_offset
-						)
-					),
-					contents=OrderedDict()
+					author=author,
+					mail=mail,
+					date=date,
+					contents=contents
 				)
 
 			# Add commit details to the entry
-			entry.contents.setdefault(
-				commit.author.name,
+			# Commits come newest first: append them here, and
+			# reverse the list when the entry is formatted
+			contents.setdefault(
+				author,
 				[]
-			).insert(
-				0,
-				commit.message.split("\n")[0] # Pick up only the first line
+			).append(
+				message.split("\n")[0] # Pick up only the first line
 			)
 
+		if entry is not None:
+			yield format_changelog_entry(nearest_version, entry)
+
 parser = argparse.ArgumentParser(description="Builds a debian/changelog file from a git history tree")
 parser.add_argument(
 	"--commit",
@@ -593,6 +722,23 @@ if __name__ == "__main__":
 				args.git_repository
 		)
 
+	# Write the commit-graph if the repository doesn't have one yet, so
+	# that the history walks below can read parents and commit dates from
+	# it rather than parsing every commit object. An existing graph is
+	# left alone, as git keeps it updated on gc. Failures (e.g. on shallow
+	# clones or old git versions) are not fatal.
+	_graph_path = os.path.join(repository.common_dir, "objects/info")
+	if not (
+		os.path.exists(os.path.join(_graph_path, "commit-graph")) or
+		os.path.exists(os.path.join(_graph_path, "commit-graphs"))
+	):
+		subprocess.run(
+			["git", "-C", args.git_repository, "commit-graph", "write", "--reachable"],
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+			check=False
+		)
+
 	pkg = SlimPackage(
 		repository,
 		commit_hash=args.commit or repository.head.commit.hexsha,
@@ -611,8 +757,9 @@ if __name__ == "__main__":
 	version = pkg.version
 	print("I: Resulting version is %s" % version)
 
-	with open("debian/changelog", "w") as f:
-		for entry in pkg.iter_changelog():
-			f.write(entry)
+	# Changelogs are small enough to be built in memory and written
+	# with a single call
+	with open("debian/changelog", "w", encoding="utf-8") as f:
+		f.write("".join(pkg.iter_changelog()))
 
 